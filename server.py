@@ -1,11 +1,81 @@
 # FILE: server.py (Final Version with HWID and IP Locking)
 
 from flask import Flask, request, jsonify
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import logging.handlers
 import os
+import queue
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import redis
+except ImportError:
+    redis = None
 
 app = Flask(__name__)
 
+# Render fronts the app with one proxy hop; ProxyFix rewrites REMOTE_ADDR
+# from X-Forwarded-For once per request in the WSGI layer, so
+# request.remote_addr is already the real client IP everywhere.
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
+
+# --- Non-blocking logging ---
+# Records are pushed onto an in-memory queue and written to stderr by a
+# background listener thread, so request threads never block on the stdout
+# lock the old print() calls serialized on.
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(_log_queue)])
+log = logging.getLogger(__name__)
+
+# --- Use orjson for all jsonify/get_json calls when available ---
+# orjson serializes several times faster than the stdlib encoder; on the
+# error paths (no upstream I/O) encoding is most of the work. Falls back
+# to Flask's default provider if orjson isn't installed.
+if orjson is not None:
+    from flask.json.provider import JSONProvider
+
+    class OrjsonProvider(JSONProvider):
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+    app.json = OrjsonProvider(app)
+
+# --- Shared HTTP session with keep-alive pooling ---
+# A fresh requests.post() opens a new TCP+TLS connection to Cryptolens on
+# every /validate call; reusing a pooled session skips the handshake on all
+# but the first request. Retries cover transient upstream 5xx hiccups;
+# allowed_methods must include POST (urllib3 excludes it by default), which
+# is safe because activating the same (key, hwid) pair is idempotent.
+HTTP = requests.Session()
+HTTP.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=(502, 503, 504),
+                      allowed_methods=None),
+))
+
+# (connect, read) timeouts so a stalled upstream can't hang a worker forever
+UPSTREAM_TIMEOUT = (3, 10)
+
 # --- Load secrets from Render's Environment Variables ---
 CRYPTOLENS_TOKEN = os.environ.get("CRYPTOLENS_TOKEN")
 PRODUCT_ID = os.environ.get("PRODUCT_ID")
@@ -13,15 +83,162 @@ ORBITAL_API_KEY = os.environ.get("ORBITAL_API_KEY")
 
 CRYPTOLENS_API_URL = "https://api.cryptolens.io/api/key/activate"
 
-# --- In-memory dictionary to store temporary IP sessions ---
-# Key: HWID, Value: User's IP Address
-IP_SESSIONS = {}
+# Environment is fixed for the process lifetime, so check it once at
+# import instead of rebuilding the list on every /validate call.
+CONFIG_OK = all([CRYPTOLENS_TOKEN, PRODUCT_ID, ORBITAL_API_KEY])
+
+class ShardedSessionStore:
+    """Thread-safe session store sharded across N locked dicts.
+
+    Gunicorn may run handlers on multiple threads (gthread/gevent), and the
+    old plain-dict store had check-then-act races like
+    `if hwid in IP_SESSIONS: del IP_SESSIONS[hwid]`. Each operation here
+    holds only the lock for the shard its key hashes to, so writers on
+    different HWIDs never contend.
+    """
+
+    def __init__(self, shards=16):
+        self._shards = [(threading.Lock(), {}) for _ in range(shards)]
+
+    def _shard(self, key):
+        return self._shards[hash(key) & (len(self._shards) - 1)]
+
+    def get(self, key, default=None):
+        lock, data = self._shard(key)
+        with lock:
+            return data.get(key, default)
+
+    def set(self, key, value):
+        lock, data = self._shard(key)
+        with lock:
+            data[key] = value
+
+    def pop(self, key, default=None):
+        lock, data = self._shard(key)
+        with lock:
+            return data.pop(key, default)
+
+    def items(self):
+        """Snapshot of all (key, value) pairs, taken shard by shard."""
+        snapshot = []
+        for lock, data in self._shards:
+            with lock:
+                snapshot.extend(data.items())
+        return snapshot
+
+
+class RedisSessionStore:
+    """IP session store backed by Redis so every Gunicorn worker sees it.
+
+    With several workers (or autoscaled dynos) the in-process store breaks:
+    /request_session can land on worker A and /validate on worker B, which
+    has no entry. SETEX gives these keys server-side TTL expiry, so they
+    need no sweeping either.
+    """
+
+    _PREFIX = "ipsess:"
+
+    def __init__(self, url):
+        self._redis = redis.Redis.from_url(url, decode_responses=True,
+                                           socket_keepalive=True)
 
-def get_user_ip():
-    """Correctly gets the user's real IP address from behind Render's proxy."""
-    if 'X-Forwarded-For' in request.headers:
-        return request.headers['X-Forwarded-For'].split(',')[0].strip()
-    return request.remote_addr
+    def get(self, key, default=None):
+        raw = self._redis.get(self._PREFIX + key)
+        if raw is None:
+            return default
+        return SessionEntry(*json.loads(raw))
+
+    def set(self, key, value):
+        self._redis.setex(self._PREFIX + key, SESSION_TTL_SECONDS,
+                          json.dumps(list(value)))
+
+    def pop(self, key, default=None):
+        # GET+DEL in one pipeline round-trip so the entry can't be
+        # validated twice
+        name = self._PREFIX + key
+        pipe = self._redis.pipeline()
+        pipe.get(name)
+        pipe.delete(name)
+        raw, _ = pipe.execute()
+        if raw is None:
+            return default
+        return SessionEntry(*json.loads(raw))
+
+
+# --- Store for temporary IP sessions ---
+# Key: HWID, Value: SessionEntry
+# A namedtuple costs a fraction of a per-session dict and gives named,
+# C-level field access.
+SessionEntry = collections.namedtuple('SessionEntry', 'ip_address created_at')
+
+# Shared Redis when configured (required for more than one worker); the
+# in-process sharded store remains the single-worker fallback.
+REDIS_URL = os.environ.get("REDIS_URL")
+
+if redis is not None and REDIS_URL:
+    IP_SESSIONS = RedisSessionStore(REDIS_URL)
+else:
+    IP_SESSIONS = ShardedSessionStore()
+
+# A session only needs to live long enough for the client to follow up with
+# /validate. Without a TTL, every client that never calls /validate would
+# leak its (hwid, ip) entry forever.
+SESSION_TTL_SECONDS = 60
+SWEEP_INTERVAL_SECONDS = 60
+
+# --- Short-lived cache of successful Cryptolens activations ---
+# Key: sha256(license_key|hwid), Value: (expiry time, Cryptolens response)
+# A (key, hwid) pair that activated fine usually keeps activating fine, so
+# repeat validations within the TTL skip the upstream call. Failures are
+# never cached so a revoked key is refused on the very next attempt.
+CRYPTOLENS_CACHE = ShardedSessionStore()
+CRYPTOLENS_CACHE_TTL_SECONDS = 300
+
+def _activation_cache_key(license_key, hwid):
+    return hashlib.sha256(f"{license_key}|{hwid}".encode()).hexdigest()
+
+_sweeper_started = False
+
+def _sweep_sessions():
+    """Periodically evict expired IP sessions and cache entries.
+
+    The Redis-backed session store expires keys server-side, so only the
+    in-process stores need sweeping.
+    """
+    while True:
+        time.sleep(SWEEP_INTERVAL_SECONDS)
+        now = time.time()
+        cutoff = now - SESSION_TTL_SECONDS
+        if isinstance(IP_SESSIONS, ShardedSessionStore):
+            for hwid, entry in IP_SESSIONS.items():
+                if entry.created_at < cutoff:
+                    IP_SESSIONS.pop(hwid, None)
+        for cache_key, (expires_at, _) in CRYPTOLENS_CACHE.items():
+            if expires_at < now:
+                CRYPTOLENS_CACHE.pop(cache_key, None)
+
+def _start_sweeper():
+    """Start the sweeper thread once per process."""
+    global _sweeper_started
+    if _sweeper_started:
+        return
+    _sweeper_started = True
+    threading.Thread(target=_sweep_sessions, daemon=True).start()
+
+def _restart_threads_after_fork():
+    # Threads don't survive fork, so with `gunicorn --preload` the sweeper
+    # and the logging QueueListener started in the master would be gone in
+    # every worker: sessions would never be swept and log records would
+    # pile up unemitted in _log_queue. Restart both in the child. Each
+    # worker must run its own sweeper because the stores are per-process
+    # dicts.
+    global _sweeper_started
+    _sweeper_started = False
+    _start_sweeper()
+    _log_listener.start()
+
+os.register_at_fork(after_in_child=_restart_threads_after_fork)
+_start_sweeper()
 
 @app.route("/request_session", methods=["POST"])
 def request_session():
@@ -29,15 +246,18 @@ def request_session():
     Step 1: Client sends its HWID. The server records the client's IP address
     and associates it with their HWID for a short time.
     """
-    hwid = request.json.get("machine_code")
+    data = request.get_json(silent=True) or {}
+    hwid = data.get("machine_code")
     if not hwid:
         return jsonify({"status": "error", "message": "Machine code not provided."}), 400
 
-    user_ip = get_user_ip()
-    IP_SESSIONS[hwid] = user_ip
-    
-    print(f"Session requested for HWID {hwid[:10]}... from IP {user_ip}") # For your logs
+    user_ip = request.remote_addr
+    IP_SESSIONS.set(hwid, SessionEntry(user_ip, time.time()))
     
+    # %-style args are only formatted if DEBUG is actually emitted
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Session requested for HWID %s... from IP %s", hwid[:10], user_ip)
+
     return jsonify({"status": "success", "message": "Session initiated."})
 
 @app.route("/validate", methods=["POST"])
@@ -46,27 +266,40 @@ def validate_license():
     Step 2: Client sends HWID and license key. The server validates the IP,
     then checks with Cryptolens, and finally returns the API key.
     """
-    if not all([CRYPTOLENS_TOKEN, PRODUCT_ID, ORBITAL_API_KEY]):
+    if not CONFIG_OK:
         return jsonify({ "status": "error", "message": "Backend server is not configured correctly." }), 500
 
-    license_key = request.json.get("license_key")
-    hwid = request.json.get("machine_code")
+    body = request.get_json(silent=True) or {}
+    license_key = body.get("license_key")
+    hwid = body.get("machine_code")
     
     if not license_key or not hwid:
         return jsonify({"status": "error", "message": "License key or machine ID not provided."}), 400
 
     # --- IP Validation Check ---
-    current_user_ip = get_user_ip()
-    stored_ip_for_hwid = IP_SESSIONS.get(hwid)
+    current_user_ip = request.remote_addr
+    session_entry = IP_SESSIONS.get(hwid)
 
-    if not stored_ip_for_hwid:
+    if not session_entry or session_entry.created_at < time.time() - SESSION_TTL_SECONDS:
         return jsonify({"status": "error", "message": "No active session. Please restart the application."}), 403
+
+    stored_ip_for_hwid = session_entry.ip_address
         
-    if current_user_ip != stored_ip_for_hwid:
-        print(f"IP MISMATCH for HWID {hwid[:10]}... | Stored: {stored_ip_for_hwid}, Current: {current_user_ip}")
+    # compare_digest runs in constant time, so the check can't leak how
+    # much of the stored IP a spoofed request managed to match
+    if not hmac.compare_digest(current_user_ip, stored_ip_for_hwid):
+        log.warning("IP MISMATCH for HWID %s... | Stored: %s, Current: %s",
+                    hwid[:10], stored_ip_for_hwid, current_user_ip)
         return jsonify({"status": "error", "message": "IP address mismatch. Please restart the application."}), 403
     
-    # IP check passed, now validate with Cryptolens
+    # IP check passed; answer from the activation cache if we can
+    cache_key = _activation_cache_key(license_key, hwid)
+    cached = CRYPTOLENS_CACHE.get(cache_key)
+    if cached and cached[0] > time.time():
+        IP_SESSIONS.pop(hwid, None)
+        return jsonify({ "status": "success", "api_key": ORBITAL_API_KEY })
+
+    # Cache miss, validate with Cryptolens
     payload = {
         "token": CRYPTOLENS_TOKEN,
         "ProductId": PRODUCT_ID,
@@ -75,17 +308,20 @@ def validate_license():
     }
 
     try:
-        response = requests.post(CRYPTOLENS_API_URL, data=payload)
+        response = HTTP.post(CRYPTOLENS_API_URL, data=payload, timeout=UPSTREAM_TIMEOUT)
         response.raise_for_status()
         data = response.json()
 
-        # IMPORTANT: Clean up the session so it can't be re-used
-        if hwid in IP_SESSIONS:
-            del IP_SESSIONS[hwid]
+        # IMPORTANT: Clean up the session so it can't be re-used.
+        # pop() is atomic inside the shard lock, so two concurrent
+        # /validate calls can't both pass the check-then-delete.
+        IP_SESSIONS.pop(hwid, None)
 
         if data.get("result") != 0:
             return jsonify({ "status": "error", "message": data.get("message", "Invalid key or machine.") }), 403
-        
+
+        CRYPTOLENS_CACHE.set(cache_key, (time.time() + CRYPTOLENS_CACHE_TTL_SECONDS, data))
+
         # --- SUCCESS ---
         # Respond with the secret OrbitalStress API key
         return jsonify({ "status": "success", "api_key": ORBITAL_API_KEY })